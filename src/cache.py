@@ -0,0 +1,15 @@
+import os, tempfile
+from pathlib import Path
+
+def write_atomic(path, data):
+    """Write bytes via temp file + os.replace - a killed run never leaves a truncated cache hit"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
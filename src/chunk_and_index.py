@@ -1,115 +1,277 @@
-import json, os, uuid
+import functools, hashlib, os, uuid, random, time
+from array import array
+from pathlib import Path
+import ijson
+import orjson
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 from openai import OpenAI
 from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents import SearchIndexingBufferedSender
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
-    SearchIndex, SearchField, SearchFieldDataType
+    SearchIndex, SearchField, SearchFieldDataType,
+    VectorSearch, VectorSearchProfile, HnswAlgorithmConfiguration, HnswParameters,
+    ScalarQuantizationCompression, ScalarQuantizationParameters
 )
+from retry import openai_retry, azure_retry
+from cache import write_atomic
 
-load_dotenv()
+# Clients are built on first use - importing semantic_chunking needs no credentials
+@functools.lru_cache(maxsize=1)
+def get_openai():
+    """YOUR PERSONAL OpenAI (for testing)"""
+    load_dotenv()
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)  # openai_retry owns retries
 
-# YOUR PERSONAL OpenAI (for testing)
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+@functools.lru_cache(maxsize=1)
+def get_search_settings():
+    """YOUR AI Search → (endpoint, credential)"""
+    load_dotenv()
+    return os.getenv("AZURE_SEARCH_ENDPOINT"), AzureKeyCredential(os.getenv("AZURE_SEARCH_KEY"))
 
-# YOUR AI Search
-search_endpoint = os.getenv("AZURE_SEARCH_ENDPOINT")
-search_key = os.getenv("AZURE_SEARCH_KEY")
+@functools.lru_cache(maxsize=1)
+def get_index_client():
+    endpoint, credential = get_search_settings()
+    return SearchIndexClient(endpoint=endpoint, credential=credential, retry_total=0)  # azure_retry owns retries
 
-def semantic_chunking(raw_chunks, target_chars=1000):
-    """201 raw chunks → ~50 semantic chunks"""
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    
-    print(f"🔪 Chunking {len(raw_chunks)} raw lines...")
+# Chunk ids are uuid5(doc_name + content) so re-ingesting a PDF updates docs in place
+CHUNK_ID_NAMESPACE = uuid.UUID("6ba7b810-9dad-11d1-80b4-00c04fd430c8")
+
+# Service error codes for "existing field cannot be changed" on create_or_update_index
+SCHEMA_CONFLICT_CODES = {"OperationNotAllowed", "CannotChangeExistingField"}
+
+SEARCH_MAX_BATCH_DOCS = 32000  # Azure Search per-request document limit
+SEARCH_MAX_BATCH_BYTES = 12 * 1024 * 1024  # Real headroom under the 16 MB payload limit
+SEARCH_JSON_OVERHEAD = 1.1  # SDK's spaced json.dumps runs ~4-7% over compact orjson
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSIONS = 512  # Matryoshka-truncated from 1536 by the API
+EMBEDDING_BATCH_SIZE = 2048  # OpenAI max inputs per embeddings request
+EMBEDDING_BATCH_TOKENS = 250_000  # Headroom under OpenAI's 300k tokens per request
+EMBEDDING_CHARS_PER_TOKEN = 3  # Conservative estimate (English averages ~4)
+EMBEDDING_WORKERS = 4  # Batches in flight at once
+EMBEDDING_CACHE_DIR = Path("./output/.cache/embeddings")  # Keyed on model + dims + content
+
+def semantic_chunking(raw_chunks, doc_name, window_chars=1000, stride_chars=750):
+    """201 raw chunks → overlapping semantic chunks (K=window_chars, S=stride_chars)"""
+    print("🔪 Chunking raw lines...")
     
-    for item in raw_chunks:
-        text = item['content'].strip()
+    # One streaming pass: only kept items are held in memory, fragments are dropped as read
+    items = []
+    lens = array('i')
+    for x in raw_chunks:
+        text = x['content'].strip()  # Strip once - joined below as-is
         if len(text) < 20:  # Skip fragments
             continue
-            
-        text_len = len(text)
-        
-        if current_length + text_len > target_chars and current_chunk:
-            chunks.append({
-                "id": str(uuid.uuid4()),
-                "content": ". ".join([c['content'] for c in current_chunk]),
-                "page": current_chunk[0]['page'],
-                "type": current_chunk[0]['type'],
-                "doc_name": "support.pdf"
-            })
-            current_chunk = [item]
-            current_length = text_len
-        else:
-            current_chunk.append(item)
-            current_length += text_len
-    
-    # Final chunk
-    if current_chunk:
-        chunks.append({
-            "id": str(uuid.uuid4()),
-            "content": ". ".join([c['content'] for c in current_chunk]),
-            "page": current_chunk[0]['page'],
-            "type": current_chunk[0]['type'],
-            "doc_name": "support.pdf"
-        })
-    
-    print(f"✅ Created {len(chunks)} semantic chunks")
-    return chunks
+        x['content'] = text
+        items.append(x)
+        lens.append(len(text))
+    if not items:
+        print("✅ Created 0 semantic chunks")
+        return
+    
+    # Sliding window over character offsets: ceil((N-K)/S)+1 windows, K-S overlap
+    cs = np.asarray(lens, dtype=np.int64).cumsum()
+    total = int(cs[-1])
+    n_windows = -(-max(total - window_chars, 0) // stride_chars) + 1
+    starts = np.arange(n_windows) * stride_chars
+    ends = np.minimum(starts + window_chars, total)
+    
+    # Items overlapping [start, end): first one ending after start → first one reaching end
+    first = np.searchsorted(cs, starts, side="right")
+    last = np.minimum(np.searchsorted(cs, ends, side="left") + 1, len(items))
+    contents = [x['content'] for x in items]
+    
+    n_chunks = 0
+    prev_end = 0
+    for start, end in zip(first, last):
+        if end <= prev_end:  # Items already all inside the previous chunk
+            continue
+        prev_end = end
+        n_chunks += 1
+        content = ". ".join(contents[start:end])
+        yield {
+            "id": str(uuid.uuid5(CHUNK_ID_NAMESPACE, f"{doc_name}:{content}")),
+            "content": content,
+            "page": items[start]['page'],
+            "type": items[start]['type'],
+            "doc_name": doc_name
+        }
+    
+    print(f"✅ Created {n_chunks} semantic chunks")
 
 def create_simple_index():
     """✅ NO ENUM ISSUES - Pure string types"""
-    index_client = SearchIndexClient(
-        endpoint=search_endpoint, 
-        credential=AzureKeyCredential(search_key)
-    )
+    index_client = get_index_client()
     
     fields = [
         SearchField(name="id", type="Edm.String", key=True),
         SearchField(name="content", type="Edm.String", searchable=True, retrievable=True),
-        SearchField(name="page", type="Edm.Int32", filterable=True, sortable=True),
-        SearchField(name="type", type="Edm.String", filterable=True),
-        SearchField(name="doc_name", type="Edm.String", filterable=True)
+        # Nothing filters/sorts/facets on these yet - service defaults are True, so opt out
+        # explicitly to skip that per-document indexing work
+        SearchField(name="page", type="Edm.Int32", filterable=False, sortable=False, facetable=False),
+        SearchField(name="type", type="Edm.String", filterable=False, sortable=False, facetable=False),
+        SearchField(name="doc_name", type="Edm.String", filterable=False, sortable=False, facetable=False),
+        SearchField(
+            name="contentVector", type="Collection(Edm.Single)", searchable=True,
+            vector_search_dimensions=EMBEDDING_DIMENSIONS, vector_search_profile_name="hnsw"
+        )
     ]
     
-    index = SearchIndex(name="itpolicy-nist-index", fields=fields)
+    vector_search = VectorSearch(
+        profiles=[VectorSearchProfile(
+            name="hnsw", algorithm_configuration_name="hnsw-config", compression_name="int8-sq"
+        )],
+        # Lean graph for bulk load: m=4 keeps per-insert link work low
+        algorithms=[HnswAlgorithmConfiguration(
+            name="hnsw-config",
+            parameters=HnswParameters(m=4, ef_construction=200)
+        )],
+        # Store the graph as int8 - 4x smaller than float32
+        compressions=[ScalarQuantizationCompression(
+            compression_name="int8-sq",
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8")
+        )]
+    )
+    
+    index = SearchIndex(name="itpolicy-nist-index", fields=fields, vector_search=vector_search)
     
     try:
-        index_client.create_or_update_index(index)
+        azure_retry(index_client.create_or_update_index)(index)
         print("✅ SIMPLE INDEX created: itpolicy-nist-index")
-        return True
-    except Exception as e:
-        print(f"✅ Index exists: {str(e)[:100]}...")
-        return True
+    except HttpResponseError as e:
+        # Only an existing field that can't be altered in place (vector dims, field
+        # attributes) is fixable by a rebuild - anything else is a real bad request
+        code = getattr(e.error, "code", None)
+        if code not in SCHEMA_CONFLICT_CODES:
+            raise
+        if os.getenv("AZURE_SEARCH_RECREATE_INDEX") != "1":
+            raise RuntimeError(
+                "itpolicy-nist-index has an incompatible schema. Set AZURE_SEARCH_RECREATE_INDEX=1 "
+                "to delete and rebuild it (drops ALL indexed documents), then re-run."
+            ) from e
+        print(f"♻️  Schema changed - recreating itpolicy-nist-index: {str(e)[:100]}...")
+        azure_retry(index_client.delete_index)(index.name)
+        azure_retry(index_client.create_or_update_index)(index)
+        print("✅ SIMPLE INDEX recreated: itpolicy-nist-index")
+    return True
 
 def test_openai_embedding():
     """Quick test of YOUR OpenAI key"""
     try:
-        embedding = openai_client.embeddings.create(
-            model="text-embedding-3-small",
-            input=["test policy document"]
+        embedding = get_openai().embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=["test policy document"],
+            dimensions=EMBEDDING_DIMENSIONS
         )
-        print("✅ OpenAI key working: 1536-dim embeddings ready")
+        print(f"✅ OpenAI key working: {EMBEDDING_DIMENSIONS}-dim embeddings ready")
         return True
     except Exception as e:
         print(f"❌ OpenAI error: {e}")
         return False
 
-def index_chunks(chunks):
-    """Index to YOUR rag-ai-search-workshop"""
-    search_client = SearchClient(
-        endpoint=search_endpoint,
-        index_name="itpolicy-nist-index",
-        credential=AzureKeyCredential(search_key)
+@openai_retry
+def embed_batch(batch):
+    """One embeddings call for up to 2048 chunks"""
+    return get_openai().embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=[c["content"] for c in batch],
+        dimensions=EMBEDDING_DIMENSIONS
     )
+
+def embedding_batches(chunks):
+    """Split into batches of ≤2048 inputs and ≤~250k estimated tokens"""
+    batches, batch, tokens = [], [], 0
+    for chunk in chunks:
+        chunk_tokens = len(chunk["content"]) // EMBEDDING_CHARS_PER_TOKEN + 1
+        if batch and (len(batch) == EMBEDDING_BATCH_SIZE or tokens + chunk_tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(chunk)
+        tokens += chunk_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def embedding_cache_path(content):
+    key = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}:{content}".encode()
+    return EMBEDDING_CACHE_DIR / f"{hashlib.blake2b(key, digest_size=16).hexdigest()}.json"
+
+def embed_chunks(chunks):
+    """Token-capped batches of ≤2048 embedded in parallel → chunk["contentVector"] (cached chunks skip the API)"""
+    todo = []
+    for chunk in chunks:
+        cache = embedding_cache_path(chunk["content"])
+        if cache.exists():
+            chunk["contentVector"] = orjson.loads(cache.read_bytes())
+        else:
+            todo.append(chunk)
     
-    print(f"📤 Indexing {len(chunks)} chunks...")
-    result = search_client.upload_documents(chunks)
+    batches = embedding_batches(todo)
+    print(f"🧮 Embedding {len(todo)} chunks in {len(batches)} batches ({len(chunks) - len(todo)} cached)...")
+    if not batches:
+        return chunks
     
-    succeeded = sum(1 for r in result if r.succeeded)
-    failed = len(chunks) - succeeded
+    get_openai()  # Build once before worker threads race for it
+    with ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS) as ex:
+        futures = {}
+        for i, batch in enumerate(batches):
+            time.sleep(random.uniform(0, 0.2))  # Jitter - avoid 429 spikes
+            futures[ex.submit(embed_batch, batch)] = i
+        
+        for future in as_completed(futures):
+            batch = batches[futures[future]]
+            for data in future.result().data:
+                chunk = batch[data.index]
+                chunk["contentVector"] = data.embedding
+                write_atomic(embedding_cache_path(chunk["content"]), orjson.dumps(data.embedding))
+    
+    print(f"✅ Embedded {len(chunks)} chunks")
+    return chunks
+
+def upload_batch_size(chunks, sample_size=100):
+    """Docs per upload request: as many of the largest sampled doc as fit in ~12 MB, capped at 32000"""
+    sample = chunks[::max(1, len(chunks) // sample_size)]  # Spread across the whole corpus
+    if not sample:
+        return 1
+    max_bytes = max(len(orjson.dumps(c, option=orjson.OPT_SERIALIZE_NUMPY)) for c in sample) * SEARCH_JSON_OVERHEAD
+    return max(1, min(SEARCH_MAX_BATCH_DOCS, int(SEARCH_MAX_BATCH_BYTES // max_bytes)))
+
+def index_chunks(chunks):
+    """Index to YOUR rag-ai-search-workshop (auto-batched, retries 207/429)"""
+    succeeded = 0
+    failed = 0
+    
+    def on_progress(action):
+        nonlocal succeeded
+        succeeded += 1
+    
+    def on_error(action):
+        nonlocal failed
+        failed += 1
+    
+    batch_size = upload_batch_size(chunks)
+    print(f"📤 Indexing {len(chunks)} chunks (up to {batch_size} per request)...")
+    endpoint, credential = get_search_settings()
+    with SearchIndexingBufferedSender(
+        endpoint=endpoint,
+        index_name="itpolicy-nist-index",
+        credential=credential,
+        auto_flush_interval=5,
+        initial_batch_action_count=batch_size,  # Flush as soon as one slice is queued
+        on_progress=on_progress,
+        on_error=on_error
+    ) as sender:
+        # The sender sends everything queued in one request, so feed it one
+        # size-capped slice at a time - each slice becomes a single flush
+        for i in range(0, len(chunks), batch_size):
+            sender.upload_documents(chunks[i:i + batch_size])
+    # Leaving the context flushes every pending batch
     
     print(f"🎉 SUCCESS: {succeeded}/{len(chunks)} indexed!")
     print(f"   Failed: {failed}")
@@ -121,12 +283,6 @@ def index_chunks(chunks):
 if __name__ == "__main__":
     print("🚀 DAY 3: Chunking + Indexing (16 pages)")
     
-    # Load your data
-    with open("./output/nist-sp800-53.json", "r") as f:
-        raw_content = json.load(f)
-    
-    print(f"📄 Loaded {len(raw_content)} raw chunks from 16 pages")
-    
     # 1. Test OpenAI key
     if not test_openai_embedding():
         print("⚠️  OpenAI key issue - fix .env then rerun")
@@ -135,22 +291,30 @@ if __name__ == "__main__":
     # 2. Create simple index
     create_simple_index()
     
-    # 3. Semantic chunking
-    chunks = semantic_chunking(raw_content)
+    # 3. Semantic chunking - stream raw chunks straight from disk
+    raw_path = "./output/nist-sp800-53.json"
+    doc_name = os.path.basename(raw_path).replace(".json", ".pdf")  # ingest.py names output after the PDF
+    with open(raw_path, "rb") as f:
+        raw_iter = ijson.items(f, "item")
+        chunks = list(semantic_chunking(raw_iter, doc_name))
+    
+    # 4. Embed for vector search
+    embed_chunks(chunks)
     
     # Save chunks for inspection
-    with open("./output/nist_chunks_indexed.json", "w") as f:
-        json.dump(chunks, f, indent=2)
+    # Parquet: dictionary-encodes the repetitive doc_name/type/page columns
+    # Reload with: pq.read_table("./output/nist_chunks_indexed.parquet").to_pylist()
+    pq.write_table(pa.Table.from_pylist(chunks), "./output/nist_chunks_indexed.parquet", compression="zstd")
     
     print(f"📋 Sample: {chunks[0]['content'][:150]}...")
     
-    # 4. Index!
+    # 5. Index!
     success = index_chunks(chunks)
     
     if success:
         print("\n🎉 DAY 3 100% COMPLETE!")
         print("✅ Portal: rag-ai-search-workshop → Indexes → itpolicy-nist-index")
-        print("✅ Local: ./output/nist_chunks_indexed.json (~50 chunks)")
+        print("✅ Local: ./output/nist_chunks_indexed.parquet")
         print("✅ Ready for Day 4: RAG queries!")
     else:
         print("\n❌ Some indexing failed - check Azure Portal logs")
@@ -1,26 +1,63 @@
-import os, json
-from azure.ai.documentintelligence import DocumentIntelligenceClient
+import functools, hashlib, os, asyncio
+from pathlib import Path
+import aiofiles
+import orjson
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 from azure.storage.blob import BlobServiceClient
 from dotenv import load_dotenv
+from retry import azure_retry
+from cache import write_atomic
 
-load_dotenv()
+BLOB_BLOCK_SIZE = 8 * 1024 * 1024  # 8 MiB blocks (AzCopy default) - half the commit RPCs of 4 MiB
+BLOB_UPLOAD_CONCURRENCY = 4  # Blocks staged in parallel for multi-block PDFs
 
-# YOUR resources
-blob_conn = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-di_endpoint = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT")
-di_key = os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY")
+# YOUR resources - clients are built on first use, not at import
+@functools.lru_cache(maxsize=1)
+def get_blob_client():
+    load_dotenv()
+    return BlobServiceClient.from_connection_string(
+        os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+        max_block_size=BLOB_BLOCK_SIZE,
+        max_single_put_size=BLOB_BLOCK_SIZE
+    )
 
-blob_client = BlobServiceClient.from_connection_string(blob_conn)
-di_client = DocumentIntelligenceClient(endpoint=di_endpoint, credential=AzureKeyCredential(di_key))
+def get_di_client():
+    """Not cached: an async client belongs to the event loop that opened it"""
+    load_dotenv()
+    return DocumentIntelligenceClient(
+        endpoint=os.getenv("AZURE_DOCUMENT_INTELLIGENCE_ENDPOINT"),
+        credential=AzureKeyCredential(os.getenv("AZURE_DOCUMENT_INTELLIGENCE_KEY")),
+        retry_total=0  # azure_retry owns retries
+    )
 
-def analyze_document(file_path):
-    """✅ ROBUST: Handles ALL Document Intelligence response formats"""
+# Max PDFs in flight against Document Intelligence at once
+MAX_CONCURRENT_ANALYSES = 8
+
+DI_MODEL = "prebuilt-layout"
+
+# DI output is deterministic per file - cached by content hash so reruns skip the API.
+# Bump DI_PARSER_VERSION whenever analyze_document's element format changes.
+DI_CACHE_DIR = Path("./output/.cache")
+DI_PARSER_VERSION = 1
+
+@azure_retry
+async def begin_analysis(di_client, data):
+    return await di_client.begin_analyze_document(DI_MODEL, body=data)
+
+async def analyze_document(di_client, data):
+    """✅ ROBUST: Handles ALL Document Intelligence response formats (PDF bytes in)"""
+    key = hashlib.blake2b(f"{DI_MODEL}:{DI_PARSER_VERSION}:".encode(), digest_size=16)
+    key.update(data)
+    cache = DI_CACHE_DIR / f"{key.hexdigest()}.json"
+    if cache.exists():
+        print("⚡ Cache hit - skipping Document Intelligence")
+        return orjson.loads(cache.read_bytes())
+    
     print("🔍 Analyzing with Document Intelligence...")
     
-    with open(file_path, "rb") as f:
-        poller = di_client.begin_analyze_document("prebuilt-layout", body=f)
-        result = poller.result()
+    poller = await begin_analysis(di_client, data)
+    result = await poller.result()
     
     content = []
     
@@ -43,24 +80,21 @@ def analyze_document(file_path):
                 content.append({
                     "type": "line", 
                     "content": line.content or "",
-                    "page": page_num,
-                    "confidence": getattr(line, 'confidence', 0.0)
+                    "page": page_num
                 })
         
         # METHOD 3: TABLES (if present)
         if hasattr(page, 'tables') and page.tables:
             for table in page.tables:
-                table_content = []
+                # Tab-separated cells, one line per row
+                rows = {}
                 for cell in table.cells or []:
-                    cell_text = f"R{cell.row_index}C{cell.column_index}: {getattr(cell, 'content', '')}"
-                    table_content.append(cell_text)
+                    rows.setdefault(cell.row_index, {})[cell.column_index] = getattr(cell, 'content', '') or ''
                 
                 content.append({
                     "type": "table",
-                    "content": "\n".join(table_content),
-                    "page": page_num,
-                    "rows": getattr(table, 'row_count', 0),
-                    "cols": getattr(table, 'column_count', 0)
+                    "content": "\n".join("\t".join(cols[c] for c in sorted(cols)) for _, cols in sorted(rows.items())),
+                    "page": page_num
                 })
         
         # METHOD 4: WORDS fallback (last resort)
@@ -72,28 +106,36 @@ def analyze_document(file_path):
                 "page": page_num
             })
     
+    write_atomic(cache, orjson.dumps(content))
+    
     print(f"✅ Extracted {len(content)} content elements")
     return content
 
-def ingest_file(local_path):
+async def ingest_file(di_client, local_path):
     """✅ Complete pipeline for YOUR resources"""
-    container = blob_client.get_container_client("documents")
+    container = get_blob_client().get_container_client("documents")
     blob_name = os.path.basename(local_path)
     
-    # 1. Upload to YOUR jagann1storage1/documents/
+    async with aiofiles.open(local_path, "rb") as f:
+        data = await f.read()  # Read once - shared by upload and analysis
+    
+    # 1. Upload to YOUR jagann1storage1/documents/ while
+    # 2. Parsing with YOUR rag-ai-servies-workshop - both legs run concurrently
     print(f"📤 Uploading {blob_name}...")
-    with open(local_path, "rb") as f:
-        container.upload_blob(blob_name, f, overwrite=True)
+    _, parsed = await asyncio.gather(
+        asyncio.to_thread(
+            container.upload_blob, blob_name, data, overwrite=True,
+            length=len(data), max_concurrency=BLOB_UPLOAD_CONCURRENCY
+        ),  # sync SDK call - keep it off the event loop
+        analyze_document(di_client, data)
+    )
     print("✅ Blob upload complete")
     
-    # 2. Parse with YOUR rag-ai-servies-workshop
-    parsed = analyze_document(local_path)
-    
     # 3. Save JSON output
     os.makedirs("./output", exist_ok=True)
     output_path = f"./output/{blob_name.replace('.pdf', '')}.json"
-    with open(output_path, "w") as f:
-        json.dump(parsed[:500], f, indent=2)  # First 500 chunks for Day 2
+    with open(output_path, "wb") as f:
+        f.write(orjson.dumps(parsed[:500]))  # First 500 chunks for Day 2
     
     # 4. Preview first few items
     print("\n📋 SAMPLE OUTPUT:")
@@ -103,6 +145,20 @@ def ingest_file(local_path):
     print(f"\n🎉 DAY 2 SUCCESS: {len(parsed)} elements → {output_path}")
     return parsed
 
+async def ingest_many(di_client, paths, max_concurrency=MAX_CONCURRENT_ANALYSES):
+    """✅ Ingest many PDFs concurrently - wall clock ≈ slowest file, not the sum"""
+    sem = asyncio.Semaphore(max_concurrency)
+    
+    async def one(path):
+        async with sem:
+            return await ingest_file(di_client, path)
+    
+    return await asyncio.gather(*[one(p) for p in paths])
+
+async def main():
+    async with get_di_client() as di_client:
+        # WORKS WITH ANY PDF IN YOUR docs/ folder
+        await ingest_many(di_client, ["./docs/nist-sp800-53.pdf"])  # or nist-sp800-53.pdf or support.pdf
+
 if __name__ == "__main__":
-    # WORKS WITH ANY PDF IN YOUR docs/ folder
-    ingest_file("./docs/nist-sp800-53.pdf")  # or nist-sp800-53.pdf or support.pdf
+    asyncio.run(main())
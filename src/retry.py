@@ -0,0 +1,85 @@
+import functools, os, threading, time
+from azure.core.exceptions import HttpResponseError
+from dotenv import load_dotenv
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import (
+    retry, retry_if_exception, retry_if_exception_type,
+    stop_after_attempt, wait_random_exponential
+)
+
+# Transient statuses worth retrying on Azure (Search, Document Intelligence)
+AZURE_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+_backoff = wait_random_exponential(min=1, max=60)
+
+def _wait_retry_after(retry_state):
+    """Honor the server's Retry-After header, else back off exponentially"""
+    exc = retry_state.outcome.exception()
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return min(float(headers["retry-after"]), 60)
+    except (KeyError, TypeError, ValueError):
+        return _backoff(retry_state)
+
+class TokenBucket:
+    """Thread-safe token bucket: bursts up to max(`rps`, 1) calls, refills at `rps`/s"""
+    def __init__(self, rps):
+        self.rps = rps
+        self.capacity = max(rps, 1)  # Below 1 rps a cap of `rps` could never reach a whole token
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rps:
+            return  # Unlimited
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rps)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rps
+            time.sleep(delay)
+
+_openai_bucket_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _build_openai_bucket():
+    """Pre-throttle below the account tier (default 3500 RPM) so retries stay the fallback"""
+    load_dotenv()
+    return TokenBucket(float(os.getenv("OPENAI_MAX_REQUESTS_PER_MINUTE", "3500")) / 60)
+
+def _openai_bucket():
+    with _openai_bucket_lock:  # Worker threads must all share one bucket
+        return _build_openai_bucket()
+
+_openai_retry = retry(
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)),
+    reraise=True
+)
+
+def openai_retry(fn):
+    """✅ Throttle + retry 429/5xx/connection errors on OpenAI calls"""
+    @_openai_retry
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _openai_bucket().acquire()
+        return fn(*args, **kwargs)
+    return wrapper
+
+def _is_transient_azure_error(exc):
+    return isinstance(exc, HttpResponseError) and exc.status_code in AZURE_RETRY_STATUSES
+
+# Works on both sync and async callables (tenacity detects coroutines)
+azure_retry = retry(
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception(_is_transient_azure_error),
+    reraise=True
+)